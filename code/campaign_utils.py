@@ -0,0 +1,156 @@
+"""
+Shared helpers for the GHZ asymmetry campaign scripts: parity and shot
+decoding, cached transpilation, batched submission and job polling.
+"""
+
+import os
+import time
+import hashlib
+import pickle
+import numpy as np
+import qiskit
+from qiskit import qasm3, transpile
+
+TRANSPILE_CACHE_DIR = ".transpile_cache"  # Pickled transpiled circuits, reused across runs
+POLL_INTERVAL = 5  # Seconds between job status checks while waiting for results
+MAX_STATUS_FAILURES = 5  # Consecutive failed status checks before a job is handed back anyway
+
+def bit_mask(indices):
+    """Integer mask with bit i set for every qubit index i."""
+    mask = 0
+    for i in indices:
+        mask |= 1 << i
+    return mask
+
+# Popcount lookup table for NumPy < 2.0, which lacks np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def parity(values):
+    """Bitwise parity (0 or 1) of every element of a uint32 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values) & 1
+    values = np.ascontiguousarray(values, dtype=np.uint32)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 4).sum(axis=1) & 1
+
+def shot_outcomes(bit_array):
+    """
+    Integer outcome of every shot in a BitArray; bit i is clbit i.
+    
+    BitArray rows are big-endian bytes. For 1, 2 or 4 bytes per shot (up to
+    32 clbits) the buffer is reinterpreted in place as big-endian unsigned
+    integers; other widths are combined most significant byte first.
+    """
+    rows = np.ascontiguousarray(bit_array.array.reshape(-1, bit_array.array.shape[-1]))
+    num_bytes = rows.shape[1]
+    if num_bytes in (1, 2, 4):
+        return rows.view(f">u{num_bytes}")[:, 0]
+    weights = np.uint32(1) << (8 * np.arange(num_bytes - 1, -1, -1, dtype=np.uint32))
+    return rows @ weights
+
+_transpile_cache = {}
+
+def _calibration_stamp(backend):
+    """Time of the backend's last calibration, or None if it does not report one."""
+    try:
+        properties = backend.properties()
+    except Exception:
+        return None
+    stamp = getattr(properties, "last_update_date", None)
+    return str(stamp) if stamp is not None else None
+
+def cached_transpile(circuits, backend, optimization_level=1):
+    """
+    Transpile a list of circuits for the backend, reusing earlier results.
+    
+    Results are keyed by a SHA1 of (backend, calibration time, OpenQASM 3
+    source, optimization level, Qiskit version), kept in memory for this run
+    and pickled to TRANSPILE_CACHE_DIR for later runs. A new calibration
+    therefore gets a fresh noise-aware layout; backends that report no
+    calibration time are only cached in memory. Identical circuits share one entry.
+    All cache misses go through a single transpile() call, which Qiskit
+    parallelizes across cores and which builds the pass manager only once.
+    """
+    calibrated = _calibration_stamp(backend)
+    use_disk = calibrated is not None
+    keys = []
+    missing = {}
+    for qc in circuits:
+        source = repr((backend.name, calibrated, qasm3.dumps(qc), optimization_level, qiskit.__version__))
+        key = hashlib.sha1(source.encode("utf-8")).hexdigest()
+        keys.append(key)
+        if key in _transpile_cache or key in missing:
+            continue
+
+        path = os.path.join(TRANSPILE_CACHE_DIR, f"{key}.pkl")
+        if use_disk and os.path.isfile(path):
+            with open(path, "rb") as f:
+                _transpile_cache[key] = pickle.load(f)
+        else:
+            missing[key] = qc
+
+    if missing:
+        t_qcs = transpile(list(missing.values()), backend, optimization_level=optimization_level)
+        if use_disk:
+            os.makedirs(TRANSPILE_CACHE_DIR, exist_ok=True)
+        for key, t_qc in zip(missing, t_qcs):
+            if use_disk:
+                with open(os.path.join(TRANSPILE_CACHE_DIR, f"{key}.pkl"), "wb") as f:
+                    pickle.dump(t_qc, f)
+            _transpile_cache[key] = t_qc
+
+    return [_transpile_cache[key] for key in keys]
+
+def submit_batched(sampler, backend, pubs, run_entries, shots):
+    """
+    Submit all PUBs as a single job, split only if the backend caps circuits per job.
+    
+    Each run entry is updated with its job, job_id and pub_index (its position
+    within that job's result). Returns the entries whose batch was submitted.
+    """
+    submitted = []
+    batch_size = backend.max_circuits or len(pubs)
+    for start in range(0, len(pubs), batch_size):
+        batch = slice(start, start + batch_size)
+        try:
+            job = sampler.run(pubs[batch], shots=shots)
+            job_id = job.job_id()
+            print(f" -> Submitted {len(pubs[batch])} PUBs! Job ID: {job_id}")
+            for pub_index, entry in enumerate(run_entries[batch]):
+                entry.update(job=job, job_id=job_id, pub_index=pub_index)
+                submitted.append(entry)
+        except Exception as e:
+            print(f" -> Submission FAILED: {e}")
+    return submitted
+
+def as_completed(entries, poll_interval=POLL_INTERVAL, max_failures=MAX_STATUS_FAILURES):
+    """
+    Yield submitted run entries as soon as their job reaches a final state.
+    
+    All pending jobs are checked every poll_interval seconds, so a job still
+    queued does not hold up results that are already available. Entries that
+    share a batch job are yielded together. A failed status check is logged
+    and retried next round; after max_failures consecutive failures the job
+    is yielded anyway, so the caller's job.result() reports the error.
+    """
+    pending = list(entries)
+    failures = {}  # job_id -> consecutive failed status checks
+    while pending:
+        finished = {}  # job_id -> bool, one status check per job per round
+        still_pending = []
+        for entry in pending:
+            job_id = entry["job_id"]
+            if job_id not in finished:
+                try:
+                    finished[job_id] = entry["job"].in_final_state()
+                    failures[job_id] = 0
+                except Exception as e:
+                    failures[job_id] = failures.get(job_id, 0) + 1
+                    print(f"Status check failed for job {job_id} ({failures[job_id]}/{max_failures}): {e}")
+                    finished[job_id] = failures[job_id] >= max_failures
+            if finished[job_id]:
+                yield entry
+            else:
+                still_pending.append(entry)
+        pending = still_pending
+        if pending:
+            time.sleep(poll_interval)
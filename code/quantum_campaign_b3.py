@@ -1,11 +1,11 @@
 import os
 import csv
-import time
 import numpy as np
 from collections import Counter
 from datetime import datetime
-from qiskit import QuantumCircuit, transpile
+from qiskit import QuantumCircuit
 from qiskit_ibm_runtime import QiskitRuntimeService, SamplerV2 as Sampler
+from campaign_utils import bit_mask, parity, shot_outcomes, cached_transpile, submit_batched, as_completed
 
 # --- Configuration ---
 SHOTS = 8192
@@ -55,9 +55,17 @@ def get_backend():
     candidates = ["ibm_torino", "ibm_fez", "ibm_sherbrooke", "ibm_brisbane", "ibm_kyoto", "ibm_osaka"]
     backend = None
     
+    # One bulk request for all hardware, then filter locally (status() is checked per candidate)
+    all_backends = {b.name: b for b in service.backends(simulator=False)}
+    if not all_backends:
+        print("No hardware backends available.")
+        return service, None
+    
     for name in candidates:
+        b = all_backends.get(name)
+        if b is None:
+            continue
         try:
-            b = service.backend(name)
             status = b.status()
             if status.operational and status.pending_jobs < 500:
                 backend = b
@@ -109,176 +117,148 @@ def get_ordered_data(config):
     remaining = [x for x in ghz if x not in loc_a]
     return loc_a + remaining
 
-def analyze_results(counts, data_qubits, anc_global, anc_local):
-    total = sum(counts.values())
-    if total == 0: return 0, 0, 0
+def build_analysis_masks(topology_map):
+    # Parity masks depend only on the topology, so main() builds them once
+    # per topology instead of once per analyzed job.
+    data_qubits = topology_map["data"]
+    return {
+        "mask_global": np.uint32(bit_mask(data_qubits)),
+        "mask_local": np.uint32(bit_mask(data_qubits[:3])), # first 3 of data_qubits
+        "anc_global": topology_map["anc_global"],
+        "anc_local": topology_map["anc_local"]
+    }
 
-    global_ok = 0
-    localA_ok = 0
-    
-    # We need to map the output bits back to logical meaning.
-    # The circuit has 8 qubits, measured 0..7 to 0..7.
-    # Qiskit bitstring is reversed: bit 0 is rightmost.
-    # Our logical indices:
-    # data_qubits: list of 6 integers (part of 0..7 range? No, probably mapped to physical by transpile? 
-    # Wait, the circuit uses indices passed in `topology_map`. 
-    # We pass virtual 0..5 as data, 6 as global, 7 as local.
-    # Logic in circuit: `qc = QuantumCircuit(8, 8)`. Indices 0..7.
-    # `data_qubits` passed to function should be integers in 0..7.
-    # `anc_global` = 6
-    # `anc_local` = 7
-    # So `data_qubits` must be [0,1,2,3,4,5] (reordered).
-    
-    # When analyzing:
-    # bits_rev[i] corresponds to measurement of qubit i.
-    
-    for state, c in counts.items():
-        if isinstance(state, int):
-            bits = format(state, '08b')
-        else:
-            bits = state.replace(" ", "")
-            # Pad if necessary? Usually standard length.
-            
-        bits_rev = bits[::-1] # bit 0 is at index 0
-        
-        # Check Global Parity
-        # Sum of '1's in data_qubits vs anc_global
-        measured_ghz = [bits_rev[i] for i in data_qubits]
-        computed_global = measured_ghz.count("1") % 2
-        measured_global_ancilla = int(bits_rev[anc_global])
-        
-        if measured_global_ancilla == computed_global:
-            global_ok += c
-            
-        # Check Local Parity (first 3 of data_qubits vs anc_local)
-        measured_locA = [bits_rev[i] for i in data_qubits[:3]]
-        computed_locA = measured_locA.count("1") % 2
-        measured_locA_ancilla = int(bits_rev[anc_local])
-        
-        if measured_locA_ancilla == computed_locA:
-            localA_ok += c
+def _analyze_outcomes(keys, vals, masks):
+    total = int(vals.sum())
+    if total == 0: return 0, 0
+
+    # Check Global Parity
+    # Parity of data_qubits vs anc_global
+    computed_global = parity(keys & masks["mask_global"])
+    global_ok = int(vals[computed_global == ((keys >> masks["anc_global"]) & 1)].sum())
+
+    # Check Local Parity (first 3 of data_qubits vs anc_local)
+    computed_locA = parity(keys & masks["mask_local"])
+    localA_ok = int(vals[computed_locA == ((keys >> masks["anc_local"]) & 1)].sum())
 
     G = global_ok / total
     LA = localA_ok / total
-    # Entropy? The user didn't explicitly ask for entropy in the B3 prompt but usually we track it.
-    # But for now let's return metrics for CSV.
-    
+
     return G, LA
 
+def analyze_shots(bit_array, masks):
+    # Global and local stability from SamplerV2 shot data, computed on a
+    # histogram of the raw integer shot outcomes.
+    vals = np.bincount(shot_outcomes(bit_array))
+    keys = np.arange(vals.size, dtype=np.uint32)
+    return _analyze_outcomes(keys, vals, masks)
+
+# Standard virtual mapping for our 8-qubit circuit: 0..5 data, 6 Global, 7 Local
+# (TOPOLOGIES entries are orderings of the virtual data qubits 0..5, used as CX targets as-is)
+ANC_GLOBAL = 6
+ANC_LOCAL = 7
+
+# TOPOLOGIES is fixed, so the topology maps and their circuits are built once at import
+TOPOLOGY_MAPS = {
+    run_label: {
+        "data": get_ordered_data(config),
+        "anc_global": ANC_GLOBAL,
+        "anc_local": ANC_LOCAL
+    }
+    for run_label, config in TOPOLOGIES.items()
+}
+_PREBUILT = {run_label: classical_control_circuit(topology_map) for run_label, topology_map in TOPOLOGY_MAPS.items()}
+
 def main():
     service, backend = get_backend()
     if not backend:
         print("CRITICAL: No backend found.")
         return
 
-    # Initialize CSV if not exists
-    file_exists = os.path.isfile(CAMPAIGN_LOG_FILE)
-    if not file_exists:
-        with open(CAMPAIGN_LOG_FILE, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["backend", "run_label", "job_id", "global_stability (%)", "local_A (%)", "local_B (%)", "asymmetry (%)", "shots"])
+    # Open the CSV once for the whole campaign (line buffered, so each row
+    # is flushed as soon as it is written); add the header if it is new
+    need_header = not os.path.isfile(CAMPAIGN_LOG_FILE)
+    with open(CAMPAIGN_LOG_FILE, "a", newline="", buffering=1) as csv_fh:
+        csv_writer = csv.writer(csv_fh)
+        if need_header:
+            csv_writer.writerow(["backend", "run_label", "job_id", "global_stability (%)", "local_A (%)", "local_B (%)", "asymmetry (%)", "shots"])
 
-    submitted_jobs = []
+        pubs = []
+        run_entries = []
 
-    print(f"\n--- Starting B3 Campaign: {REPETITIONS} runs per config ---")
-    sampler = Sampler(mode=backend)
+        print(f"\n--- Starting B3 Campaign: {REPETITIONS} runs per config ---")
+        sampler = Sampler(mode=backend)
 
-    # We use virtual indices 0..5 for data, 6 for global ancilla, 7 for local ancilla
-    # But `data_qubits` needs to be permuted based on the topology logic
-    # Wait, `get_ordered_data` returns physical indices from TOPOLOGIES?
-    # No, TOPOLOGIES contains integers 0..5. These are virtual indices mapped to the circuit.
-    # Yes, `TOPOLOGIES` definitions are just permutations of 0..5.
-    # So `get_ordered_data` returns a list of integers from 0..5.
-    
-    # Standard virtual mapping for our 8-qubit circuit:
-    # We will use indices 0..5 for the data qubits, 6 for Global, 7 for Local.
-    # `get_ordered_data` gives us the *order* in which to apply `cx`.
-    # BUT, `data_qubits` in `classical_control_circuit` are used as arguments to `cx`.
-    # `qc.cx(q, anc_local)`
-    # If `q` is 0, it means qubit 0.
-    # So `get_ordered_data` effectively maps "logical role" to "virtual qubit index".
-    # Result: Correct.
-    
-    ANC_GLOBAL = 6
-    ANC_LOCAL = 7
+        # Transpile the prebuilt per-topology circuits in one call
+        # (identical circuits share a cache entry)
+        # The four circuits can NOT be collapsed into one with post-hoc relabeling:
+        # `data_qubits[:3]` selects which qubits get a CX onto the local ancilla
+        # ({0,1,2}, {1,2,3}, {2,3,4}, {0,2,4} for A-D), so the ancilla only ever
+        # holds the parity of the subset that was physically coupled to it.
+        circuits = list(_PREBUILT.values())
+        t_qcs = cached_transpile(circuits, backend, optimization_level=1)
+        t_by_label = dict(zip(_PREBUILT.keys(), t_qcs))
+        analysis_masks = {label: build_analysis_masks(topology_map) for label, topology_map in TOPOLOGY_MAPS.items()}
 
-    # 1. SUBMISSION PHASE
-    for run_label, config in TOPOLOGIES.items():
-        ordered_data = get_ordered_data(config)
-        
-        topology_map = {
-            "data": ordered_data,
-            "anc_global": ANC_GLOBAL,
-            "anc_local": ANC_LOCAL
-        }
+        # 1. SUBMISSION PHASE
+        for run_label, config in TOPOLOGIES.items():
+            topology_map = TOPOLOGY_MAPS[run_label]
+            t_qc = t_by_label[run_label]
         
-        for i in range(1, REPETITIONS + 1):
-            print(f"Preparing {run_label} - Run {i}/{REPETITIONS}...")
-            # Build circuit
-            qc = classical_control_circuit(topology_map)
-            
-            # Transpile
-            t_qc = transpile(qc, backend, optimization_level=1)
-            
-            try:
-                job = sampler.run([t_qc], shots=SHOTS)
-                job_id = job.job_id()
-                print(f" -> Submitted! Job ID: {job_id}")
-                submitted_jobs.append({
-                    "job": job,
-                    "job_id": job_id,
+            for i in range(1, REPETITIONS + 1):
+                print(f"Preparing {run_label} - Run {i}/{REPETITIONS}...")
+                pubs.append(t_qc)
+                run_entries.append({
                     "run_label": run_label,
                     "config": config, # Original config for ref if needed
                     "topology_map": topology_map, # Used for analysis
-                    "rep": i
+                    "rep": i,
+                    "field_name": t_qc.cregs[0].name
                 })
-                time.sleep(1) 
-            except Exception as e:
-                print(f" -> Submission FAILED: {e}")
 
-    print("\n--- All jobs submitted. Waiting for results... ---")
+        submitted_jobs = submit_batched(sampler, backend, pubs, run_entries, SHOTS)
 
-    # 2. COLLECTION PHASE
-    for entry in submitted_jobs:
-        job = entry["job"]
-        run_label = entry["run_label"]
-        job_id = entry["job_id"]
-        topo_map = entry["topology_map"]
+        print("\n--- All jobs submitted. Waiting for results... ---")
+
+        # 2. COLLECTION PHASE (in the order jobs finish)
+        results = {}
+        for entry in as_completed(submitted_jobs):
+            job = entry["job"]
+            run_label = entry["run_label"]
+            job_id = entry["job_id"]
         
-        print(f"Waiting for Job {job_id} ({run_label})...")
-        try:
-            result = job.result()
-            
+            print(f"Processing Job {job_id} ({run_label} - Run {entry['rep']})...")
             try:
-                pub_result = result[0]
-                data_bin = pub_result.data
-                field_name = [f for f in dir(data_bin) if not f.startswith('_')][0]
-                counts = getattr(data_bin, field_name).get_counts()
-            except Exception as e:
-                print(f"Error extracting counts for {job_id}: {e}")
-                continue
+                if job_id not in results:
+                    results[job_id] = job.result()
+                result = results[job_id]
+            
+                try:
+                    pub_result = result[entry["pub_index"]]
+                    bit_array = getattr(pub_result.data, entry["field_name"])
+                except Exception as e:
+                    print(f"Error extracting shot data for {job_id}: {e}")
+                    continue
 
-            G, LA = analyze_results(counts, topo_map["data"], topo_map["anc_global"], topo_map["anc_local"])
+                G, LA = analyze_shots(bit_array, analysis_masks[run_label])
             
-            row = [
-                backend.name,
-                run_label,
-                job_id,
-                f"{G*100:.2f}",
-                f"{LA*100:.2f}",
-                "0.00", # Local B N/A
-                "0.00", # Asymmetry N/A
-                SHOTS
-            ]
+                row = [
+                    backend.name,
+                    run_label,
+                    f"{job_id}:{entry['pub_index']}",
+                    f"{G*100:.2f}",
+                    f"{LA*100:.2f}",
+                    "0.00", # Local B N/A
+                    "0.00", # Asymmetry N/A
+                    SHOTS
+                ]
             
-            with open(CAMPAIGN_LOG_FILE, "a", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(row)
+                csv_writer.writerow(row)
                 
-            print(f" -> Done. G:{G*100:.1f}% LA:{LA*100:.1f}%")
+                print(f" -> Done. G:{G*100:.1f}% LA:{LA*100:.1f}%")
             
-        except Exception as e:
-            print(f"Failed to retrieve/process job {job_id}: {e}")
+            except Exception as e:
+                print(f"Failed to retrieve/process job {job_id}: {e}")
 
     print("\nB3 Campaign Completed.")
 
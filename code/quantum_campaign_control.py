@@ -7,12 +7,13 @@ Description: Generates product states (H on all qubits, no CNOT entanglement)
 
 import os
 import csv
-import time
 import numpy as np
+from scipy.special import entr
 from collections import Counter
 from datetime import datetime
-from qiskit import QuantumCircuit, transpile
+from qiskit import QuantumCircuit
 from qiskit_ibm_runtime import QiskitRuntimeService, SamplerV2 as Sampler
+from campaign_utils import bit_mask, parity, shot_outcomes, cached_transpile, submit_batched, as_completed
 
 # --- Configuration ---
 SHOTS = 8192
@@ -86,9 +87,17 @@ def get_backend():
     candidates = ["ibm_torino", "ibm_fez", "ibm_sherbrooke", "ibm_brisbane", "ibm_kyoto", "ibm_osaka"]
     backend = None
     
+    # One bulk request for all hardware, then filter locally (status() is checked per candidate)
+    all_backends = {b.name: b for b in service.backends(simulator=False)}
+    if not all_backends:
+        print("No hardware backends available.")
+        return service, None
+    
     for name in candidates:
+        b = all_backends.get(name)
+        if b is None:
+            continue
         try:
-            b = service.backend(name)
             status = b.status()
             if status.operational and status.pending_jobs < 500:
                 backend = b
@@ -145,75 +154,74 @@ def build_circuit(config):
     qc.measure(range(9), range(9))
     return qc
 
-def analyze_results(counts, config):
+# TOPOLOGIES is fixed, so every topology's circuit is built once at import
+_PREBUILT = {label: build_circuit(config) for label, config in TOPOLOGIES.items()}
+
+def _shannon_entropy(counts):
+    """Shannon entropy (bits) of a histogram given as an array of counts."""
+    p = np.asarray(counts, dtype=np.float64)
+    # entr(p) = -p*ln(p) with entr(0) = 0, so empty bins need no filtering
+    return float(entr(p / p.sum()).sum() / np.log(2))
+
+def build_analysis_masks(config):
     """
-    Analyze measurement results and calculate stability metrics.
+    Precompute the parity masks of one topology (bit i = qubit i).
     
-    Returns:
-    - G: Global stability (parity check correctness)
-    - LA: Local A stability
-    - LB: Local B stability
-    - AI: Asymmetry index |LA - LB|
-    - H: Shannon entropy of measurement distribution
+    Built once per topology in main() and reused for every repetition.
     """
-    total = sum(counts.values())
-    if total == 0: 
+    return {
+        "mask_ghz": np.uint32(bit_mask(config["ghz_indices"])),
+        "mask_la": np.uint32(bit_mask(config["local_a_indices"])),
+        "mask_lb": np.uint32(bit_mask(config["local_b_indices"])),
+        "anc_g": 6,   # Global parity ancilla
+        "anc_la": 7,  # Local A parity ancilla
+        "anc_lb": 8   # Local B parity ancilla
+    }
+
+def _analyze_outcomes(keys, vals, masks):
+    """Stability metrics for integer outcomes `keys` observed `vals` times each."""
+    total = int(vals.sum())
+    if total == 0:
         return 0, 0, 0, 0, 0
-    
-    global_ok = 0
-    localA_ok = 0
-    localB_ok = 0
-    
-    ghz_nodes = config["ghz_indices"]
-    loc_a_nodes = config["local_a_indices"]
-    loc_b_nodes = config["local_b_indices"]
 
-    probs = []
-    
-    for state, c in counts.items():
-        p = c / total
-        if p > 0: 
-            probs.append(p)
-        
-        # Handle bitstring format
-        if isinstance(state, int):
-            bits = format(state, '09b')
-        else:
-            bits = state.replace(" ", "")
-            
-        bits_rev = bits[::-1]  # Qiskit bit ordering (LSB first)
-        
-        # Global parity check
-        measured_ghz = [bits_rev[i] for i in ghz_nodes]
-        computed_global = measured_ghz.count("1") % 2
-        measured_global_ancilla = int(bits_rev[6])
-        if measured_global_ancilla == computed_global:
-            global_ok += c
-            
-        # Local A parity check
-        measured_locA = [bits_rev[i] for i in loc_a_nodes]
-        computed_locA = measured_locA.count("1") % 2
-        measured_locA_ancilla = int(bits_rev[7])
-        if measured_locA_ancilla == computed_locA:
-            localA_ok += c
-            
-        # Local B parity check
-        measured_locB = [bits_rev[i] for i in loc_b_nodes]
-        computed_locB = measured_locB.count("1") % 2
-        measured_locB_ancilla = int(bits_rev[8])
-        if measured_locB_ancilla == computed_locB:
-            localB_ok += c
-            
+    # Global parity check
+    global_ok = int(vals[parity(keys & masks["mask_ghz"]) == ((keys >> masks["anc_g"]) & 1)].sum())
+
+    # Local A parity check
+    localA_ok = int(vals[parity(keys & masks["mask_la"]) == ((keys >> masks["anc_la"]) & 1)].sum())
+
+    # Local B parity check
+    localB_ok = int(vals[parity(keys & masks["mask_lb"]) == ((keys >> masks["anc_lb"]) & 1)].sum())
+
     G = global_ok / total
     LA = localA_ok / total
     LB = localB_ok / total
     AI = abs(LA - LB)
-    
+
     # Shannon entropy
-    entropy = -sum(pr * np.log2(pr) for pr in probs if pr > 0)
-    
+    entropy = _shannon_entropy(vals)
+
     return G, LA, LB, AI, entropy
 
+def analyze_shots(bit_array, masks):
+    """
+    Calculate stability metrics directly from SamplerV2 shot data.
+    
+    Shots are histogrammed with np.bincount over their integer outcomes
+    (bit i = qubit i) and all parity checks are evaluated as vectorized
+    operations against the precomputed masks from build_analysis_masks().
+    
+    Returns:
+    - G: Global stability (parity check correctness)
+    - LA: Local A stability
+    - LB: Local B stability
+    - AI: Asymmetry index |LA - LB|
+    - H: Shannon entropy of measurement distribution
+    """
+    vals = np.bincount(shot_outcomes(bit_array))
+    keys = np.arange(vals.size, dtype=np.uint32)
+    return _analyze_outcomes(keys, vals, masks)
+
 def main():
     """Main campaign execution."""
     service, backend = get_backend()
@@ -221,89 +229,92 @@ def main():
         print("CRITICAL: No backend found.")
         return
 
-    # Initialize CSV log file
-    file_exists = os.path.isfile(CAMPAIGN_LOG_FILE)
-    if not file_exists:
-        with open(CAMPAIGN_LOG_FILE, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([
+    # Initialize CSV log file: one handle for the whole campaign, line
+    # buffered so every row is still flushed as soon as it is written
+    need_header = not os.path.isfile(CAMPAIGN_LOG_FILE)
+    with open(CAMPAIGN_LOG_FILE, "a", newline="", buffering=1) as csv_fh:
+        csv_writer = csv.writer(csv_fh)
+        if need_header:
+            csv_writer.writerow([
                 "backend", "run_label", "job_id", 
                 "global_stability (%)", "local_A (%)", "local_B (%)", 
                 "asymmetry (%)", "shots"
             ])
 
-    submitted_jobs = []
+        pubs = []
+        run_entries = []
 
-    print(f"\n--- Starting Control Campaign: {REPETITIONS} runs per config (Total {4*REPETITIONS} jobs) ---")
-    sampler = Sampler(mode=backend)
+        print(f"\n--- Starting Control Campaign: {REPETITIONS} runs per config (Total {4*REPETITIONS} PUBs) ---")
+        sampler = Sampler(mode=backend)
 
-    # 1. JOB SUBMISSION PHASE
-    for run_label, config in TOPOLOGIES.items():
-        for i in range(1, REPETITIONS + 1):
-            print(f"Preparing {run_label} - Run {i}/{REPETITIONS}...")
-            qc = build_circuit(config)
-            t_qc = transpile(qc, backend, optimization_level=1)
-            
-            try:
-                job = sampler.run([t_qc], shots=SHOTS)
-                job_id = job.job_id()
-                print(f" -> Submitted! Job ID: {job_id}")
-                submitted_jobs.append({
-                    "job": job,
-                    "job_id": job_id,
+        # 1. JOB SUBMISSION PHASE
+        # Every repetition runs the same circuit: transpile the prebuilt
+        # topology circuits together, once
+        circuits = list(_PREBUILT.values())
+        t_qcs = cached_transpile(circuits, backend, optimization_level=1)
+        t_by_label = dict(zip(_PREBUILT.keys(), t_qcs))
+
+        # Parity masks depend only on the topology: build them once
+        analysis_masks = {label: build_analysis_masks(config) for label, config in TOPOLOGIES.items()}
+
+        for run_label, config in TOPOLOGIES.items():
+            t_qc = t_by_label[run_label]
+        
+            for i in range(1, REPETITIONS + 1):
+                print(f"Preparing {run_label} - Run {i}/{REPETITIONS}...")
+                pubs.append(t_qc)
+                run_entries.append({
                     "run_label": run_label,
                     "config": config,
-                    "rep": i
+                    "rep": i,
+                    "field_name": t_qc.cregs[0].name  # Data bin field = classical register name
                 })
-                time.sleep(1)  # Avoid rate limits
-            except Exception as e:
-                print(f" -> Submission FAILED: {e}")
 
-    print("\n--- All jobs submitted. Waiting for results... ---")
+        submitted_jobs = submit_batched(sampler, backend, pubs, run_entries, SHOTS)
 
-    # 2. RESULT COLLECTION PHASE
-    for entry in submitted_jobs:
-        job = entry["job"]
-        run_label = entry["run_label"]
-        job_id = entry["job_id"]
-        config = entry["config"]
+        print("\n--- All jobs submitted. Waiting for results... ---")
+
+        # 2. RESULT COLLECTION PHASE (in the order jobs finish)
+        results = {}  # job_id -> PrimitiveResult, fetched once per batch job
+        for entry in as_completed(submitted_jobs):
+            job = entry["job"]
+            run_label = entry["run_label"]
+            job_id = entry["job_id"]
         
-        print(f"Waiting for Job {job_id} ({run_label})...")
-        try:
-            result = job.result()
-            
-            # Extract counts from result
+            print(f"Processing Job {job_id} ({run_label} - Run {entry['rep']})...")
             try:
-                pub_result = result[0]
-                data_bin = pub_result.data
-                field_name = [f for f in dir(data_bin) if not f.startswith('_')][0]
-                counts = getattr(data_bin, field_name).get_counts()
-            except Exception as e:
-                print(f"Error extracting counts for {job_id}: {e}")
-                continue
+                if job_id not in results:
+                    results[job_id] = job.result()
+                result = results[job_id]
+            
+                # Extract raw shot data from result
+                try:
+                    pub_result = result[entry["pub_index"]]
+                    bit_array = getattr(pub_result.data, entry["field_name"])
+                except Exception as e:
+                    print(f"Error extracting shot data for {job_id}: {e}")
+                    continue
 
-            G, LA, LB, AI, H = analyze_results(counts, config)
+                G, LA, LB, AI, H = analyze_shots(bit_array, analysis_masks[run_label])
             
-            # Save to CSV
-            row = [
-                backend.name,
-                run_label,
-                job_id,
-                f"{G*100:.2f}",
-                f"{LA*100:.2f}",
-                f"{LB*100:.2f}",
-                f"{AI*100:.2f}",
-                SHOTS
-            ]
+                # Save to CSV
+                row = [
+                    backend.name,
+                    run_label,
+                    f"{job_id}:{entry['pub_index']}",  # batch job ID + PUB index within it
+                    f"{G*100:.2f}",
+                    f"{LA*100:.2f}",
+                    f"{LB*100:.2f}",
+                    f"{AI*100:.2f}",
+                    SHOTS
+                ]
             
-            with open(CAMPAIGN_LOG_FILE, "a", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(row)
+                csv_writer.writerow(row)
                 
-            print(f" -> Done. G:{G*100:.1f}% AI:{AI*100:.1f}%")
+                print(f" -> Done. G:{G*100:.1f}% AI:{AI*100:.1f}%")
             
-        except Exception as e:
-            print(f"Failed to retrieve/process job {job_id}: {e}")
+            except Exception as e:
+                print(f"Failed to retrieve/process job {job_id}: {e}")
 
     print("\n✅ Control Campaign Completed.")
 